@@ -0,0 +1,265 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This is not an official Google product
+
+"""This module contains an asyncio interface to VideoUploader
+
+It lets applications that run their own asyncio event loop add videos to DCM
+concurrently and consume the results as soon as each video is finished,
+instead of waiting for the whole list of ads before activating them.
+
+The Google API client is blocking, so DCM requests are executed on a bounded
+pool of threads. Each thread uses its own connection to the DCM API (see
+VideoUploader._service).
+
+This module requires Python 3.6 or later.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+# Back-off between activation attempts of one ad, in seconds. Same values as
+# VideoUploader.activate_all_ads()
+ACTIVATION_WAIT_MIN = 1
+ACTIVATION_WAIT_MAX = 20
+ACTIVATION_MAX_DELAY = 7200
+
+# Marks the end of the rows
+_END_OF_ROWS = object()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+class AsyncVideoUploader(object):
+  """Class to add videos to DCM from an asyncio event loop.
+
+  The basic use case is the following:
+    1. Construct and initialize a VideoUploader
+    2. Construct object of this class with that VideoUploader
+    3. Iterate with 'async for' over the result of stream_videos()
+
+  Breaking out of the loop, closing the iterator or cancelling the task that
+  iterates over it stops the run: no new videos are uploaded and the method
+  waits for the DCM requests already in progress to finish, so no request is
+  left running in the background. Those requests may still create ads, which
+  are logged and added to the orphaned_results list of the VideoUploader so
+  they can be activated or removed.
+  """
+
+  def __init__(self, uploader, max_in_flight=4, max_activations=None):
+    """Constructor for AsyncVideoUploader.
+
+    Args:
+      uploader: Initialized instance of VideoUploader.
+      max_in_flight: Maximum number of videos being uploaded at the same time.
+        This is also the number of threads used to upload videos.
+      max_activations: Maximum number of ads waiting for activation at the
+        same time. Once reached, finished uploads wait for a free place
+        before their upload slot is released, so no new rows are read.
+        Defaults to 4 times max_in_flight. Activation requests use their own
+        max_in_flight threads, so they never delay uploads.
+    """
+    self._uploader = uploader
+    self._max_in_flight = max_in_flight
+    self._max_activations = max_activations or 4 * max_in_flight
+
+  async def _activate(self, ad_id, run):
+    """Activate one ad, retrying while DCM transcodes its video.
+
+    Args:
+      ad_id: ID of the ad to be activated.
+      run: Coroutine function that executes a blocking function on a thread
+        pool.
+
+    Returns:
+      True if the ad is active. False if it could not be activated before
+      giving up.
+    """
+    wait = ACTIVATION_WAIT_MIN
+    deadline = time.time() + ACTIVATION_MAX_DELAY
+    while True:
+      try:
+        if await run(self._uploader.activate_ad, ad_id):
+          return True
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        logger.warning("Exception while activating ad '%s': %s", ad_id, e)
+      if time.time() + wait > deadline:
+        logger.error("Giving up activation of ad '%s'", ad_id)
+        return False
+      await asyncio.sleep(wait)
+      wait = min(wait * 2, ACTIVATION_WAIT_MAX)
+
+  async def stream_videos(self, rows, activate=False):
+    """Add videos to DCM, yielding results as they finish.
+
+    Results are yielded in completion order, not in the order of rows. Rows are
+    only read from rows when there is room for a new upload, so rows may be a
+    long or lazy iterable.
+
+    Args:
+      rows: Iterable or asynchronous iterable of dicts with the arguments of
+        VideoUploader.new_video(): 'creative_name', 'video_file',
+        'target_zip_code' and 'landing_url'.
+      activate: Whether each ad must be activated as soon as it is created,
+        retrying with exponential back-off while DCM transcodes the video.
+        At most max_activations ads wait for activation at the same time.
+
+    Yields:
+      Dict object per row with 'row' (the row itself), 'ad_id', 'ad_name',
+      'creative_id', 'creative_name' (None if not created), 'active' (whether
+      the ad was activated), 'timings' (dict with the seconds spent on
+      'upload', 'creative', 'ad', 'activation' and 'total') and 'error' (the
+      exception that made the row fail, None if it succeeded)
+
+    If the run is stopped, the results of the rows that created an ad but
+    were not yielded are appended to the orphaned_results list of the
+    VideoUploader instead.
+    """
+    upload_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=self._max_in_flight)
+    activation_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=self._max_in_flight)
+    # Requests submitted to the executors and not finished yet
+    running = set()
+    upload_slots = asyncio.Semaphore(self._max_in_flight)
+    activation_slots = asyncio.Semaphore(self._max_activations)
+
+    def runner(executor):
+      async def run(function, *args):
+        future = executor.submit(function, *args)
+        running.add(future)
+        future.add_done_callback(running.discard)
+        return await asyncio.wrap_future(future)
+      return run
+    upload = runner(upload_executor)
+    activation = runner(activation_executor)
+    # Results of the rows started and not yielded yet, by id()
+    unreported = {}
+
+    async def process(row):
+      start = time.time()
+      result = {'row': row, 'ad_id': None, 'ad_name': None,
+                'creative_id': None, 'creative_name': None, 'active': False,
+                'timings': {}, 'error': None}
+      unreported[id(result)] = result
+
+      def traffic_video():
+        # The result is updated from the worker thread, so the ad is known
+        # even if this coroutine is cancelled while the request is running
+        info = self._uploader.traffic_video(
+            row['creative_name'], row['video_file'], row['target_zip_code'],
+            row['landing_url'])
+        result.update(info)
+        return info
+
+      try:
+        try:
+          info = await upload(traffic_video)
+          if activate:
+            # Keep the upload slot until there is room for one more ad
+            # waiting for activation, so the backlog stays bounded
+            await activation_slots.acquire()
+        finally:
+          upload_slots.release()
+        if activate:
+          try:
+            activation_start = time.time()
+            result['active'] = await self._activate(info['ad_id'], activation)
+            result['timings']['activation'] = time.time() - activation_start
+          finally:
+            activation_slots.release()
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:
+        logger.error("Exception while processing row: '%s'. Exception: %s",
+                     row, e)
+        result['error'] = e
+      result['timings']['total'] = time.time() - start
+      return result
+
+    if hasattr(rows, '__aiter__'):
+      row_iterator = rows.__aiter__()
+    else:
+      row_iterator = iter(rows)
+
+    async def next_row():
+      try:
+        if hasattr(row_iterator, '__anext__'):
+          return await row_iterator.__anext__()
+        return next(row_iterator)
+      except (StopIteration, StopAsyncIteration):
+        return _END_OF_ROWS
+
+    tasks = set()
+    slot = None
+    exhausted = False
+    try:
+      while True:
+        # Wait for a free upload slot while there are rows left, and for any
+        # row to finish
+        if slot is None and not exhausted:
+          slot = asyncio.ensure_future(upload_slots.acquire())
+        waiting = set(tasks)
+        if slot is not None:
+          waiting.add(slot)
+        if not waiting:
+          break
+        done, _ = await asyncio.wait(
+            waiting, return_when=asyncio.FIRST_COMPLETED)
+
+        if slot in done:
+          slot = None
+          row = await next_row()
+          if row is _END_OF_ROWS:
+            exhausted = True
+            upload_slots.release()
+          else:
+            tasks.add(asyncio.ensure_future(process(row)))
+
+        for task in done & tasks:
+          tasks.discard(task)
+          result = task.result()
+          del unreported[id(result)]
+          yield result
+    finally:
+      # Stop cleanly: do not start any new upload and wait for the requests
+      # already sent to DCM
+      if slot is not None:
+        slot.cancel()
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      pending_requests = [future for future in running if not future.done()]
+      if pending_requests:
+        logger.info("Waiting for %d DCM requests in progress",
+                    len(pending_requests))
+        # Results are discarded, but must be retrieved so that failed
+        # requests are not reported as never retrieved exceptions
+        await asyncio.gather(
+            *[asyncio.wrap_future(future) for future in pending_requests],
+            return_exceptions=True)
+      for result in unreported.values():
+        if result['ad_id'] is not None:
+          logger.warning("Ad '%s' with creative '%s' was created for row '%s' "
+                         "after the run was stopped", result['ad_id'],
+                         result['creative_id'], result['row'])
+          self._uploader.orphaned_results.append(result)
+      upload_executor.shutdown(wait=False)
+      activation_executor.shutdown(wait=False)
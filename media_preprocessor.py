@@ -0,0 +1,455 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This is not an official Google product
+
+"""This module contains an optional local pre-upload stage for video files
+
+Before a video is uploaded to DCM it can be probed locally (duration,
+resolution, bitrate and codec) and, if it does not match a target profile,
+remuxed or transcoded to a file that DCM accepts. Smaller files with a
+standard encoding are faster to upload and faster for DCM to transcode, which
+shortens the time until the ads can be activated.
+
+The module makes use of ffprobe and ffmpeg, which are available at
+https://ffmpeg.org/ You will need to have both of them on your PATH to be able
+to use this module.
+
+Normalised files are stored in a cache directory, keyed by a hash of the
+contents of the source file and the target profile, so the same source video
+is only processed once across rows and across runs.
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+try:
+  from shutil import which
+except ImportError:
+  from distutils.spawn import find_executable as which
+
+NORMALIZED_FILE_EXTENSION = '.mp4'
+
+# Size of the blocks read when hashing video files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def probe_video(video_file):
+  """Probe a video file.
+
+  This function uses ffprobe to extract the main properties of the first video
+  stream of a file.
+
+  Args:
+    video_file: Video filename.
+
+  Returns:
+    Dict object with 'duration' (seconds), 'width', 'height', 'bit_rate' (bits
+    per second), 'codec' and 'size' (bytes). Properties that ffprobe could not
+    determine are set to None.
+
+  Raises:
+    Exception: if ffprobe exited with error code (!=0) or the file does not
+      contain any video stream
+  """
+  command = ['ffprobe', '-v', 'error', '-print_format', 'json',
+             '-show_format', '-show_streams', video_file]
+  try:
+    output = subprocess.check_output(command)
+  except subprocess.CalledProcessError:
+    raise Exception("Error while probing file '{}'".format(video_file))
+  info = json.loads(output.decode('utf-8'))
+
+  video_streams = [stream for stream in info.get('streams', [])
+                   if stream.get('codec_type') == 'video']
+  if not video_streams:
+    raise Exception("No video stream found in file '{}'".format(video_file))
+  stream = video_streams[0]
+  file_format = info.get('format', {})
+
+  bit_rate = stream.get('bit_rate') or file_format.get('bit_rate')
+  duration = stream.get('duration') or file_format.get('duration')
+  return {
+      'duration': float(duration) if duration else None,
+      'width': stream.get('width'),
+      'height': stream.get('height'),
+      'bit_rate': int(bit_rate) if bit_rate else None,
+      'codec': stream.get('codec_name'),
+      'size': os.path.getsize(video_file)
+  }
+
+
+def hash_file(filename):
+  """Compute the SHA-256 hash of the contents of a file.
+
+  Args:
+    filename: Name of the file to hash.
+
+  Returns:
+    Hex digest of the contents of the file.
+  """
+  digest = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    block = f.read(HASH_BLOCK_SIZE)
+    while block:
+      digest.update(block)
+      block = f.read(HASH_BLOCK_SIZE)
+  return digest.hexdigest()
+
+
+def _ffmpeg_command(source_file, target_file, action, profile):
+  """Build the ffmpeg command line that normalises a video file.
+
+  Args:
+    source_file: Video filename.
+    target_file: Filename for the normalised video.
+    action: 'remux' to only change the container, 'transcode' to re-encode.
+    profile: Dict with the target profile, as built by MediaPreprocessor.
+
+  Returns:
+    List with the ffmpeg command and its arguments.
+  """
+  command = ['ffmpeg', '-v', 'error', '-y', '-i', source_file]
+  if action == 'remux':
+    command += ['-c', 'copy']
+  else:
+    command += ['-c:v', profile['video_encoder'],
+                '-c:a', profile['audio_encoder']]
+    if profile['max_bit_rate']:
+      command += ['-maxrate', str(profile['max_bit_rate']),
+                  '-bufsize', str(2 * profile['max_bit_rate'])]
+    if profile['max_height']:
+      # Keep aspect ratio and an even width, never upscale
+      command += ['-vf', 'scale=-2:min(ih\\,{})'.format(profile['max_height'])]
+  # Move the index to the start of the file so that DCM can start processing
+  # the video before it has read the whole file
+  command += ['-movflags', '+faststart', target_file]
+  return command
+
+
+def _partial_name(target_file):
+  """Get the temporary name under which a cache file is written.
+
+  Cache files are written to a temporary name first and then renamed, so that
+  an interrupted run or another worker never sees a truncated file.
+  """
+  root, extension = os.path.splitext(target_file)
+  return '{}.{}.partial{}'.format(root, os.getpid(), extension)
+
+
+def _get_action(video_file, probe, profile):
+  """Decide how a video file must be normalised.
+
+  Args:
+    video_file: Video filename.
+    probe: Properties of the video, as returned by probe_video().
+    profile: Dict with the target profile, as built by MediaPreprocessor.
+
+  Returns:
+    'transcode' if the video must be re-encoded, 'remux' if only the container
+    must be changed, None if the video can be uploaded as is.
+  """
+  if probe['codec'] != profile['video_codec']:
+    return 'transcode'
+  if (profile['max_bit_rate'] and probe['bit_rate'] and
+      probe['bit_rate'] > profile['max_bit_rate']):
+    return 'transcode'
+  if (profile['max_height'] and probe['height'] and
+      probe['height'] > profile['max_height']):
+    return 'transcode'
+  if os.path.splitext(video_file)[1].lower() != NORMALIZED_FILE_EXTENSION:
+    return 'remux'
+  return None
+
+
+def _normalize_file(source_file, target_file, action, profile):
+  """Remux or transcode a video file.
+
+  Args:
+    source_file: Video filename.
+    target_file: Filename for the normalised video.
+    action: 'remux' to only change the container, 'transcode' to re-encode.
+    profile: Dict with the target profile, as built by MediaPreprocessor.
+
+  Raises:
+    Exception: if ffmpeg exited with error code (!=0)
+  """
+  partial_file = _partial_name(target_file)
+  FNULL = open(os.devnull, 'w')
+  process = None
+  try:
+    process = subprocess.Popen(
+        _ffmpeg_command(source_file, partial_file, action, profile),
+        stdout=FNULL, stderr=subprocess.STDOUT)
+    if process.wait():
+      raise Exception("Error while normalising file '{}'".format(source_file))
+    os.rename(partial_file, target_file)
+  finally:
+    # If we are being stopped (see _init_worker()), do not leave ffmpeg running
+    if process is not None and process.poll() is None:
+      process.kill()
+      process.wait()
+    FNULL.close()
+    if os.path.exists(partial_file):
+      os.remove(partial_file)
+
+
+def _exit_on_sigterm(signum, frame):
+  """Signal handler that exits the worker, running any cleanup on the way."""
+  raise SystemExit(1)
+
+
+def _init_worker(log_level):
+  """Initialize a worker process of the pool.
+
+  Pool.terminate() stops workers with SIGTERM, which by default kills them
+  without running any finally clause. Turn it into an exception instead, so
+  that _normalize_file() can stop ffmpeg and remove its partial output.
+
+  Workers are not forked from the parent (see _get_pool_context()), so they do
+  not inherit its logging configuration either.
+
+  Args:
+    log_level: Logging level of the parent process.
+  """
+  logging.basicConfig(level=log_level)
+  signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+
+def _get_pool_context():
+  """Get the multiprocessing context used to start the workers of the pool.
+
+  By the time the pool is created the parent runs other threads (progress
+  reporting, profiler), and a child forked while one of them holds a lock,
+  e.g. the logging lock, could deadlock. Workers are therefore started from a
+  fresh process where the platform supports it.
+  """
+  if not hasattr(multiprocessing, 'get_context'):
+    # Python 2 can only fork
+    return multiprocessing
+  methods = multiprocessing.get_all_start_methods()
+  return multiprocessing.get_context(
+      'forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _preprocess_file(video_file, normalize, cache_dir, profile, profile_key):
+  """Probe and, if needed, normalise a video file.
+
+  This function may be executed inside the worker processes of the pool, so
+  it must remain a module-level function.
+
+  Args:
+    video_file: Video filename.
+    normalize: Whether the video must be normalised if it does not match the
+      target profile.
+    cache_dir: Directory where probe results and normalised videos are stored.
+    profile: Dict with the target profile, as built by MediaPreprocessor.
+    profile_key: Short identifier of the target profile.
+
+  Returns:
+    Tuple with the result of probing the original file and the name of the
+    file that must be uploaded. If normalize is False and the file could not
+    be probed, the result of probing is None.
+
+  Raises:
+    Exception: if normalize is True and the file could not be probed or
+      normalised
+  """
+  if not os.path.isdir(cache_dir):
+    try:
+      os.makedirs(cache_dir)
+    except OSError:
+      # Another worker may have created it in the meantime
+      if not os.path.isdir(cache_dir):
+        raise
+
+  content_hash = hash_file(video_file)
+  probe_file = os.path.join(cache_dir, content_hash + '.json')
+  if os.path.exists(probe_file):
+    with open(probe_file) as f:
+      probe = json.load(f)
+  else:
+    try:
+      probe = probe_video(video_file)
+    except Exception as e:
+      if normalize:
+        raise
+      # Probing is only informative if videos are not normalised, so it must
+      # not prevent the original file from being uploaded
+      logger.warning("Could not probe video '%s': %s", video_file, e)
+      return None, video_file
+    partial_file = _partial_name(probe_file)
+    with open(partial_file, 'w') as f:
+      json.dump(probe, f)
+    os.rename(partial_file, probe_file)
+  logger.info(
+      "Probed video '%s': %s s, %sx%s, %s bps, codec '%s', %d bytes",
+      video_file, probe['duration'], probe['width'], probe['height'],
+      probe['bit_rate'], probe['codec'], probe['size'])
+  if not normalize:
+    return probe, video_file
+
+  action = _get_action(video_file, probe, profile)
+  if not action:
+    return probe, video_file
+
+  target_file = os.path.join(cache_dir, '{}_{}{}'.format(
+      content_hash, profile_key, NORMALIZED_FILE_EXTENSION))
+  if os.path.exists(target_file):
+    logger.info("Using cached normalised video '%s'", target_file)
+  else:
+    logger.info("Normalising video '%s' (%s)", video_file, action)
+    _normalize_file(video_file, target_file, action, profile)
+    logger.info("Video normalised: '%s' (%d bytes)", target_file,
+                os.path.getsize(target_file))
+  return probe, target_file
+
+
+class MediaPreprocessor(object):
+  """Class to probe and normalise video files before uploading them to DCM.
+
+  The basic use case is the following:
+    1. Construct object of this class
+    2. Optionally, call prefetch() with the local video files that will be
+      uploaded, so that they are processed in a pool of worker processes
+      while other videos are being uploaded
+    3. Call preprocess() for each video right before uploading it and upload
+      the returned file instead of the original one
+    4. Call close() once all videos have been processed
+
+  If normalisation is not enabled, preprocess() only probes and logs the
+  properties of each video and returns the original file.
+  """
+
+  def __init__(self, normalize=False, cache_dir='.video_cache',
+               video_codec='h264', max_bit_rate=None, max_height=None,
+               workers=None):
+    """Constructor for MediaPreprocessor.
+
+    Args:
+      normalize: Whether videos not matching the target profile must be
+        remuxed or transcoded. If False, videos are only probed.
+      cache_dir: Directory where probe results and normalised videos are
+        stored.
+      video_codec: Video codec of the target profile, as reported by ffprobe.
+        Videos with a different codec are transcoded.
+      max_bit_rate: Maximum bitrate (bits per second) of the target profile.
+        Videos with a higher bitrate are transcoded. None for no limit.
+      max_height: Maximum height (pixels) of the target profile. Videos with a
+        higher resolution are downscaled. None for no limit.
+      workers: Number of processes used to prefetch videos. Defaults to the
+        number of CPUs.
+    """
+    self._normalize = normalize
+    self._cache_dir = cache_dir
+    self._profile = {
+        'video_codec': video_codec,
+        'video_encoder': 'libx264' if video_codec == 'h264' else video_codec,
+        'audio_encoder': 'aac',
+        'max_bit_rate': max_bit_rate,
+        'max_height': max_height
+    }
+    profile = json.dumps(self._profile, sort_keys=True).encode('utf-8')
+    self._profile_key = hashlib.sha256(profile).hexdigest()[:12]
+    self._workers = workers
+    self._pool = None
+    # Pending background results by source filename
+    self._pending = {}
+
+  def check_tools(self):
+    """Check that the external tools needed are available.
+
+    Call this method before processing any video, so that a missing tool
+    stops the run right away instead of making every row fail.
+
+    Raises:
+      Exception: if ffprobe, or ffmpeg when normalising, is not on the PATH
+    """
+    tools = ['ffprobe', 'ffmpeg'] if self._normalize else ['ffprobe']
+    missing = [tool for tool in tools if not which(tool)]
+    if missing:
+      raise Exception("Could not find {} on the PATH. See "
+                      "https://ffmpeg.org/".format(' and '.join(missing)))
+
+  def _get_args(self, video_file):
+    """Get the arguments for _preprocess_file() for a video file."""
+    return (video_file, self._normalize, self._cache_dir, self._profile,
+            self._profile_key)
+
+  def prefetch(self, video_files):
+    """Start processing a set of local video files in the background.
+
+    Files that do not exist are ignored. Errors are reported when
+    preprocess() is invoked for the failing file.
+
+    Args:
+      video_files: Iterable of video filenames.
+    """
+    for video_file in video_files:
+      if video_file in self._pending or not os.path.isfile(video_file):
+        continue
+      if self._pool is None:
+        self._pool = _get_pool_context().Pool(
+            self._workers, _init_worker,
+            (logging.getLogger().getEffectiveLevel(),))
+      self._pending[video_file] = self._pool.apply_async(
+          _preprocess_file, self._get_args(video_file))
+
+  def preprocess(self, video_file):
+    """Probe and, if configured, normalise a video file.
+
+    If the file was passed to prefetch() before, this method waits for the
+    background processing to finish. Otherwise, the file is processed right
+    away.
+
+    Args:
+      video_file: Video filename.
+
+    Returns:
+      Tuple with a dict with the properties of the original video, as returned
+      by probe_video(), and the filename that must be uploaded to DCM. This is
+      the original filename if the video did not need to be normalised. If
+      normalisation is not enabled and the video could not be probed, the
+      dict is None and the original filename is returned.
+
+    Raises:
+      Exception: if normalisation is enabled and the video could not be
+        probed or normalised
+    """
+    pending = self._pending.pop(video_file, None)
+    if pending is not None:
+      return pending.get()
+    return _preprocess_file(*self._get_args(video_file))
+
+  def close(self):
+    """Stop the worker processes.
+
+    If there is still pending work (e.g.: the run was interrupted), it is
+    discarded and any ffmpeg process in progress is stopped.
+    """
+    if self._pool is not None:
+      if self._pending:
+        self._pool.terminate()
+      else:
+        self._pool.close()
+      self._pool.join()
+      self._pool = None
+    self._pending = {}
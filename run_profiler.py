@@ -0,0 +1,252 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This is not an official Google product
+
+"""This module contains a low-overhead sampling profiler for upload runs
+
+The profiler runs in a background thread and, at a fixed interval, takes the
+Python stack of every thread. Each sample is attributed to a stage of the run
+(download, upload of the asset, creation of the creative, etc.) by looking for
+the innermost function of the stack listed in STAGES. Where the platform
+supports per-thread CPU clocks (Linux, Python 3.7 or later) the time between
+two samples of a thread is also split between on-CPU time and time spent
+waiting (network, disk, subprocesses, sleeps).
+
+The profiler writes two files:
+  - A collapsed stacks file, one stack per line with its number of samples,
+    that can be rendered with flamegraph.pl
+    (https://github.com/brendangregg/FlameGraph) or speedscope. The root frame
+    of each stack is '[cpu]' or '[wait]'
+  - A summary with the time, on-CPU time and waiting time of each stage and
+    the functions where most time was spent on each of them. Times are added
+    up across threads (thread-seconds), so with several threads busy at once
+    they can exceed the elapsed time of the run, which is also reported
+
+This module requires Python 3.
+"""
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+# Stages of a run, by (file name, function name). A sample is attributed to
+# the innermost function of its stack that appears here
+STAGES = {
+    ('upload_videos.py', 'process_row'): 'process_row',
+    ('upload_videos.py', 'download_file'): 'download',
+    ('media_preprocessor.py', 'preprocess'): 'preprocess',
+    ('video_uploader.py', 'initialize'): 'initialize',
+    ('video_uploader.py', '_upload_asset'): 'upload_asset',
+    ('video_uploader.py', '_add_video_creative'): 'create_creative',
+    ('video_uploader.py', '_assign_creative_to_placement'): 'create_ad',
+    ('video_uploader.py', 'activate_all_ads'): 'activate',
+    ('run_reporter.py', 'ad_created'): 'record_results',
+    ('run_reporter.py', 'row_failed'): 'record_results',
+    ('run_reporter.py', 'ad_activated'): 'record_results',
+}
+
+# Stage for samples of the main thread outside any of the stages above
+OTHER_STAGE = 'other'
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def _thread_cpu_time(thread_id):
+  """Get the CPU time consumed by a thread, in seconds.
+
+  Returns:
+    CPU time of the thread, or None if not supported by the platform.
+  """
+  try:
+    return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+  except (AttributeError, OSError, OverflowError):
+    return None
+
+
+def _frame_label(frame):
+  """Get the label of a stack frame for the collapsed stacks file."""
+  code = frame.f_code
+  return '{} ({})'.format(code.co_name, os.path.basename(code.co_filename))
+
+
+class SamplingProfiler(object):
+  """Class to sample the stacks of all threads of the process.
+
+  The basic use case is the following:
+    1. Construct object of this class
+    2. Call start() before the code to be profiled
+    3. Call stop() after the code to be profiled
+    4. Call write() to write the collapsed stacks and the summary
+  """
+
+  def __init__(self, interval=0.01):
+    """Constructor for SamplingProfiler.
+
+    Args:
+      interval: Seconds between two samples.
+
+    Raises:
+      Exception: if running on Python 2, where the profiler is not supported
+    """
+    if sys.version_info[0] < 3:
+      raise Exception("The profiler requires Python 3")
+    self._interval = interval
+    self._thread = None
+    self._stop_event = threading.Event()
+    # Number of samples by collapsed stack
+    self._stacks = collections.Counter()
+    # Thread-seconds of wall, CPU and waiting time by stage
+    self._stage_times = collections.defaultdict(
+        lambda: {'wall': 0.0, 'cpu': 0.0, 'wait': 0.0})
+    # Thread-seconds of wall time by stage and innermost function
+    self._leaf_times = collections.defaultdict(collections.Counter)
+    # Last (wall time, CPU time) seen for each thread
+    self._last_times = {}
+    self._cpu_supported = True
+    # Wall-clock time when sampling started and stopped
+    self._start_time = None
+    self._stop_time = None
+
+  def start(self):
+    """Start sampling in a background thread."""
+    self._stop_event.clear()
+    self._start_time = time.time()
+    self._stop_time = None
+    self._thread = threading.Thread(target=self._run, name='profiler')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Stop sampling and wait for the background thread to finish."""
+    self._stop_event.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+      self._stop_time = time.time()
+
+  def _run(self):
+    """Take samples until stop() is invoked."""
+    own_id = threading.current_thread().ident
+    main_id = threading.main_thread().ident
+    while not self._stop_event.wait(self._interval):
+      now = time.time()
+      frames = sys._current_frames()
+      # Only threads still alive are sampled: the CPU clock of a thread that
+      # has exited must not be read
+      alive = set(thread.ident for thread in threading.enumerate())
+      for thread_id in list(self._last_times):
+        if thread_id not in alive:
+          del self._last_times[thread_id]
+      for thread_id, frame in frames.items():
+        if thread_id != own_id and thread_id in alive:
+          self._sample(thread_id, frame, now, thread_id == main_id)
+
+  def _sample(self, thread_id, frame, now, is_main_thread):
+    """Record one sample of one thread.
+
+    Args:
+      thread_id: Identifier of the sampled thread.
+      frame: Innermost frame of the thread.
+      now: Time of the sample.
+      is_main_thread: Whether the sampled thread is the main thread.
+    """
+    stack = []
+    stage = None
+    while frame is not None:
+      code = frame.f_code
+      if stage is None:
+        stage = STAGES.get(
+            (os.path.basename(code.co_filename), code.co_name))
+      stack.append(_frame_label(frame))
+      frame = frame.f_back
+    if stage is None:
+      # Other threads (e.g.: worker pools) are only interesting while they
+      # are working on one of the stages
+      if not is_main_thread:
+        self._last_times.pop(thread_id, None)
+        return
+      stage = OTHER_STAGE
+
+    cpu_time = _thread_cpu_time(thread_id)
+    if cpu_time is None:
+      self._cpu_supported = False
+    last_wall, last_cpu = self._last_times.get(
+        thread_id, (now - self._interval, cpu_time))
+    self._last_times[thread_id] = (now, cpu_time)
+    wall = now - last_wall
+
+    on_cpu = 0.0
+    if cpu_time is not None and last_cpu is not None:
+      on_cpu = min(max(cpu_time - last_cpu, 0.0), wall)
+    times = self._stage_times[stage]
+    times['wall'] += wall
+    times['cpu'] += on_cpu
+    times['wait'] += wall - on_cpu
+    self._leaf_times[stage][stack[0]] += wall
+
+    state = '[cpu]' if on_cpu >= wall / 2 else '[wait]'
+    stack.reverse()
+    self._stacks[';'.join([state] + stack)] += 1
+
+  def summary(self, top=10):
+    """Get a human-readable summary of the time spent on each stage.
+
+    Args:
+      top: Number of functions to list for each stage.
+
+    Returns:
+      Summary as a string.
+    """
+    total = sum(times['wall'] for times in self._stage_times.values())
+    elapsed = 0.0
+    if self._start_time is not None:
+      elapsed = (self._stop_time or time.time()) - self._start_time
+    lines = ['Profile: %.1f s elapsed, %.1f thread-s sampled every %.0f ms '
+             '(time of all sampled threads added up)' % (
+                 elapsed, total, self._interval * 1000)]
+    if not self._cpu_supported:
+      lines.append('Per-thread CPU time not supported on this platform, all '
+                   'time is reported as waiting')
+    stages = sorted(self._stage_times.items(),
+                    key=lambda item: item[1]['wall'], reverse=True)
+    for stage, times in stages:
+      lines.append('%s: %.1f thread-s (%.1f%% of thread-s), %.1f on CPU, '
+                   '%.1f waiting' % (
+                       stage, times['wall'],
+                       100 * times['wall'] / total if total else 0,
+                       times['cpu'], times['wait']))
+      for label, seconds in self._leaf_times[stage].most_common(top):
+        lines.append('    %7.2f thread-s  %s' % (seconds, label))
+    return '\n'.join(lines)
+
+  def write(self, prefix, top=10):
+    """Write the collapsed stacks and the summary.
+
+    Args:
+      prefix: Prefix of the output files. Collapsed stacks are written to
+        '<prefix>.collapsed' and the summary to '<prefix>.txt'.
+      top: Number of functions to list for each stage in the summary.
+    """
+    with open(prefix + '.collapsed', 'w') as f:
+      for stack, count in sorted(self._stacks.items()):
+        f.write('%s %d\n' % (stack, count))
+    summary = self.summary(top)
+    with open(prefix + '.txt', 'w') as f:
+      f.write(summary + '\n')
+    logger.info(summary)
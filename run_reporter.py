@@ -0,0 +1,257 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This is not an official Google product
+
+"""This module contains helpers to report the results of a run as it goes
+
+ResultsRecorder writes the outcome of every row to the output files as soon as
+it is known, flushing after each one, so other systems can follow a run while
+it is still in progress. ProgressReporter periodically logs the throughput of
+the run and an estimate of the time left from a background thread, so progress
+is reported even while a long upload or activation is in progress.
+"""
+
+import collections
+import csv
+import json
+import logging
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+
+def _format_duration(seconds):
+  """Format a number of seconds as H:MM:SS."""
+  seconds = int(seconds)
+  return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressReporter(object):
+  """Class to log the progress of a run.
+
+  Rates are computed as a moving average over the last rows processed, so the
+  estimate adapts if the run speeds up or slows down. Call start() to log the
+  progress every interval seconds and stop() at the end of the run.
+  """
+
+  def __init__(self, total_rows, interval=30, window=50):
+    """Constructor for ProgressReporter.
+
+    Args:
+      total_rows: Number of rows that will be processed in the run.
+      interval: Seconds between two progress messages. Use 0 to disable
+        progress messages.
+      window: Number of rows used to compute the moving averages.
+    """
+    self._total_rows = total_rows
+    self._interval = interval
+    self._rows_done = 0
+    self._ads_created = 0
+    self._ads_activated = 0
+    # (time at which a row finished, bytes uploaded for that row). The first
+    # element marks the start of the window
+    self._window = collections.deque([(time.time(), 0)], maxlen=window + 1)
+    # Counters are updated by the run and read by the reporting thread
+    self._lock = threading.Lock()
+    self._thread = None
+    self._stop_event = threading.Event()
+
+  def start(self):
+    """Start logging the progress every interval seconds."""
+    if not self._interval:
+      return
+    self._stop_event.clear()
+    self._thread = threading.Thread(target=self._run, name='progress')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    """Stop logging the progress."""
+    self._stop_event.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def _run(self):
+    """Log the progress until stop() is invoked."""
+    while not self._stop_event.wait(self._interval):
+      logger.info(self.summary())
+
+  def row_finished(self, uploaded_bytes=0, created=False):
+    """Account for a processed row.
+
+    Args:
+      uploaded_bytes: Bytes uploaded to DCM for the row.
+      created: Whether a new ad was created for the row.
+    """
+    with self._lock:
+      self._rows_done += 1
+      if created:
+        self._ads_created += 1
+      self._window.append((time.time(), uploaded_bytes))
+
+  def ad_activated(self):
+    """Account for an activated ad."""
+    with self._lock:
+      self._ads_activated += 1
+
+  def summary(self):
+    """Get a human-readable description of the progress of the run."""
+    with self._lock:
+      window = list(self._window)
+      rows_done = self._rows_done
+      ads_created = self._ads_created
+      ads_activated = self._ads_activated
+    span = window[-1][0] - window[0][0]
+    rows = len(window) - 1
+    rows_per_second = rows / span if span > 0 else 0.0
+    uploaded_bytes = sum(size for _, size in window[1:])
+    mb_per_second = uploaded_bytes / span / 1000000 if span > 0 else 0.0
+    rows_left = self._total_rows - rows_done
+    if not rows_left:
+      eta = 'uploads done'
+    elif rows_per_second:
+      eta = 'ETA ' + _format_duration(rows_left / rows_per_second)
+    else:
+      eta = 'ETA unknown'
+    return ("Progress: %d/%d rows (%.2f rows/s, %.2f MB/s), %d ads created, "
+            "%d pending activation, %s" % (
+                rows_done, self._total_rows, rows_per_second, mb_per_second,
+                ads_created, ads_created - ads_activated, eta))
+
+
+class _ActivationWriter(object):
+  """CSV writer-like object that records activated ads on a ResultsRecorder.
+
+  VideoUploader.activate_all_ads() writes one row with the ad ID for every ad
+  it activates.
+  """
+
+  def __init__(self, recorder):
+    self._recorder = recorder
+
+  def writerow(self, row):
+    self._recorder.ad_activated(row[0])
+
+
+class ResultsRecorder(object):
+  """Class to record the results of a run as soon as they are known.
+
+  Every row is written to its output file and flushed right away:
+    - Ads created are written to the created CSV and as 'created' events to
+      the events file
+    - Rows that could not be processed are written to the failure CSV and as
+      'failed' events to the events file
+    - Ads activated are written to the success CSV and as 'activated' events
+      to the events file
+
+  The events file is optional and contains one JSON object per line, with the
+  'event' name, its 'time' (seconds since the epoch) and the details of the
+  event, including the time spent on each stage of the row ('durations').
+  """
+
+  def __init__(self, success_csv, failure_csv, created_csv, events_file=None,
+               progress=None):
+    """Constructor for ResultsRecorder.
+
+    Args:
+      success_csv: File object where activated ads will be written.
+      failure_csv: File object where rows that could not be processed will be
+        written.
+      created_csv: File object where ads will be written as soon as they are
+        created, before being activated. Each row contains the ad ID and name,
+        the creative ID and name, and the video file.
+      events_file: Optional file object where all events will be written in
+        JSON Lines format.
+      progress: Optional instance of ProgressReporter to be updated.
+    """
+    self._success_csv = success_csv
+    self._failure_csv = failure_csv
+    self._success_writer = csv.writer(success_csv)
+    self._failure_writer = csv.writer(failure_csv)
+    self._created_csv = created_csv
+    self._created_writer = csv.writer(created_csv)
+    self._events_file = events_file
+    self._progress = progress
+    self.success_writer = _ActivationWriter(self)
+
+  def _write_event(self, event, **details):
+    """Write one event to the events file, if any."""
+    if self._events_file is None:
+      return
+    details['event'] = event
+    details['time'] = time.time()
+    self._events_file.write(json.dumps(details, sort_keys=True) + '\n')
+    self._events_file.flush()
+
+  def ad_created(self, creative_name, video_file, info, uploaded_bytes,
+                 durations):
+    """Record a new ad.
+
+    Args:
+      creative_name: Name of the creative as requested to DCM.
+      video_file: Video filename as provided in the row.
+      info: Dict returned by VideoUploader.traffic_video().
+      uploaded_bytes: Size of the file uploaded to DCM.
+      durations: Dict with the seconds spent on each stage of the row.
+    """
+    self._created_writer.writerow(
+        [info['ad_id'], info['ad_name'], info['creative_id'],
+         info['creative_name'], video_file])
+    self._created_csv.flush()
+    self._write_event(
+        'created', creative_name=info['creative_name'],
+        requested_creative_name=creative_name, video_file=video_file,
+        ad_id=info['ad_id'], ad_name=info['ad_name'],
+        creative_id=info['creative_id'], bytes=uploaded_bytes,
+        durations=durations)
+    if self._progress:
+      self._progress.row_finished(uploaded_bytes, created=True)
+
+  def row_failed(self, creative_name, target_zip_code, video_file,
+                 landing_url, error, durations):
+    """Record a row that could not be processed.
+
+    Args:
+      creative_name: Name of the creative as requested to DCM.
+      target_zip_code: ZIP code of the row.
+      video_file: Video filename.
+      landing_url: Landing URL of the row.
+      error: Description of the error.
+      durations: Dict with the seconds spent on each stage of the row.
+    """
+    self._failure_writer.writerow(
+        [creative_name, target_zip_code, video_file, landing_url, error])
+    self._failure_csv.flush()
+    self._write_event(
+        'failed', creative_name=creative_name,
+        target_zip_code=target_zip_code, video_file=video_file,
+        landing_url=landing_url, error=error, durations=durations)
+    if self._progress:
+      self._progress.row_finished()
+
+  def ad_activated(self, ad_id):
+    """Record an activated ad.
+
+    Args:
+      ad_id: ID of the activated ad.
+    """
+    self._success_writer.writerow([ad_id])
+    self._success_csv.flush()
+    self._write_event('activated', ad_id=ad_id)
+    if self._progress:
+      self._progress.ad_activated()
@@ -45,6 +45,11 @@ import csv
 import subprocess
 import os
 import logging
+import re
+import media_preprocessor
+import run_profiler
+import run_reporter
+import time
 import video_uploader
 
 COLUMN_FILENAME = 'Filename'
@@ -96,6 +101,78 @@ argparser.add_argument(
     help="Output CSV with ads that could not be created. If for any reason "
     "any of the ads could not be created, you will find the "
     "reason in this file")
+argparser.add_argument(
+    '--created_file', type=str, default=None,
+    help="Output CSV where every ad is written, with its ID, name, creative "
+    "ID, creative name and video file, as soon as it is created and before it "
+    "is activated. Default: success_file name ending in '_created.csv'")
+argparser.add_argument(
+    '--probe_videos', action='store_true',
+    help="Probe each video locally with ffprobe (duration, resolution, "
+    "bitrate, codec) before uploading it and log its properties")
+argparser.add_argument(
+    '--normalize_videos', action='store_true',
+    help="Remux or transcode with ffmpeg, before uploading them, those videos "
+    "that do not match the target profile. Implies --probe_videos")
+argparser.add_argument(
+    '--normalize_codec', type=str, default='h264',
+    help="Video codec of the target profile, as reported by ffprobe. "
+    "Default: h264")
+argparser.add_argument(
+    '--normalize_max_bitrate', type=int, default=None,
+    help="Maximum video bitrate of the target profile, in bits per second. "
+    "Videos above this bitrate will be transcoded")
+argparser.add_argument(
+    '--normalize_max_height', type=int, default=None,
+    help="Maximum video height of the target profile, in pixels. Videos "
+    "above this resolution will be downscaled")
+argparser.add_argument(
+    '--normalize_workers', type=int, default=None,
+    help="Number of local processes used to probe and normalise videos. "
+    "Default: number of CPUs")
+argparser.add_argument(
+    '--normalize_cache_dir', type=str, default='.video_cache',
+    help="Directory where probe results and normalised videos are cached, "
+    "keyed by the hash of the original video contents")
+argparser.add_argument(
+    '--plan', action='store_true',
+    help="Do not upload anything. Instead, size every video in "
+    "creatives_list and print the number of DCM API calls, the bytes to "
+    "upload and the projected wall-clock time of the run")
+argparser.add_argument(
+    '--plan_call_latency', type=float, default=0.5,
+    help="Latency of a DCM API call, in seconds, used by --plan to project "
+    "the duration of the run. Default: 0.5")
+argparser.add_argument(
+    '--plan_bandwidth', type=float, default=20.0,
+    help="Network bandwidth, in Mbit/s, used by --plan to project the "
+    "duration of downloads and uploads. Default: 20")
+argparser.add_argument(
+    '--plan_measure_latency', action='store_true',
+    help="Measure the latency of DCM API calls with a few read-only requests "
+    "instead of using --plan_call_latency")
+argparser.add_argument(
+    '--events_file', type=str, default=None,
+    help="Output JSON Lines file where an event is written, as soon as it "
+    "happens, for every ad created, row failed and ad activated, with IDs and "
+    "the time spent on each stage")
+argparser.add_argument(
+    '--progress_interval', type=float, default=30,
+    help="Seconds between progress messages (rows/s, upload MB/s, pending "
+    "activations and ETA). Use 0 to disable them. Default: 30")
+argparser.add_argument(
+    '--profile', type=str, default=None, metavar='PREFIX',
+    help="Sample the run with a low-overhead profiler and write a "
+    "flamegraph-compatible collapsed stacks file to PREFIX.collapsed and the "
+    "time spent on each stage, split between on-CPU and waiting, to "
+    "PREFIX.txt")
+argparser.add_argument(
+    '--profile_interval', type=float, default=10,
+    help="Milliseconds between two samples of the profiler. Default: 10")
+argparser.add_argument(
+    '--profile_top', type=int, default=10,
+    help="Number of functions listed for each stage in the profile summary. "
+    "Default: 10")
 
 def download_file(url, target_file):
   """Download file from URL.
@@ -117,13 +194,201 @@ def download_file(url, target_file):
     raise Exception("Error while downloading file")
 
 
-def process_row(row, uploader, failure_writer):
+def get_remote_file_size(url):
+  """Get the size of a remote file without downloading it.
+
+  As download_file(), it uses wget in a separate process, so it's able to cope
+  with redirects.
+
+  Args:
+    url: URL of the file.
+
+  Returns:
+    Size of the file in bytes, or None if the server answered without
+    reporting it.
+
+  Raises:
+    Exception: if wget exited with error code (!=0), e.g. because the file
+      does not exist or the server could not be reached
+  """
+  process = subprocess.Popen(
+      ["wget", "--spider", "--server-response", url],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  output = process.communicate()[1].decode('utf-8', 'replace')
+  # wget prints the headers of every redirect, keep the last one
+  if process.returncode:
+    raise Exception("Error while checking file (wget exit code {})".format(
+        process.returncode))
+  sizes = re.findall(r'Content-Length:\s*(\d+)', output)
+  if not sizes:
+    return None
+  return int(sizes[-1])
+
+
+def plan_row(row):
+  """Plan the processing of one row without contacting DCM.
+
+  This method checks the row fields the same way process_row() uses them and
+  finds out the size of the video, either from the local file or from the
+  server where it will be downloaded from.
+
+  Args:
+    row: dict containing information about one video. Can be the row as output
+      from a CSVReader.
+
+  Returns:
+    Dict object with 'creative_name', 'downloaded' (whether the video has to be
+    downloaded first), 'size' (bytes, None if unknown), 'error' (reason why
+    the row will fail, None if it's expected to succeed) and 'aborts' (whether
+    the error stops the whole run instead of only the row)
+  """
+  plan = {'creative_name': row.get(COLUMN_CREATIVE_NAME),
+          'downloaded': False, 'size': None, 'error': None, 'aborts': False}
+
+  # process_row() reads these fields before it starts handling errors, so a
+  # problem with any of them stops the whole run
+  try:
+    if row.get(COLUMN_CREATIVE_NAME) is None:
+      raise Exception("Missing creative name")
+    try:
+      int(row[COLUMN_TARGET_ZIP_CODE])
+    except (KeyError, TypeError, ValueError):
+      raise Exception("Invalid ZIP code '{}'".format(
+          row.get(COLUMN_TARGET_ZIP_CODE)))
+    if COLUMN_LANDING_URL not in row:
+      raise Exception("Missing landing URL column")
+  except Exception as e:
+    plan['error'] = "{}".format(e)
+    plan['aborts'] = True
+    return plan
+
+  video_file = row.get(COLUMN_FILENAME, None)
+  if video_file:
+    if not os.path.isfile(video_file):
+      plan['error'] = "Video file '{}' not found".format(video_file)
+    else:
+      plan['size'] = os.path.getsize(video_file)
+  elif not row.get(COLUMN_FILE_URL):
+    plan['error'] = "Missing both filename and file URL"
+  else:
+    plan['downloaded'] = True
+    # A file that cannot be reached now is expected to fail to download too
+    try:
+      plan['size'] = get_remote_file_size(row[COLUMN_FILE_URL])
+    except Exception as e:
+      plan['error'] = "{}".format(e)
+  return plan
+
+
+def plan_run(rows, call_latency, bandwidth):
+  """Plan a full run without contacting DCM.
+
+  Args:
+    rows: List of dicts containing information about one video each. Can be
+      the rows as output from a CSVReader.
+    call_latency: Latency of a DCM API call, in seconds.
+    bandwidth: Network bandwidth, in Mbit/s.
+
+  Returns:
+    Dict object with 'rows', 'processed' (number of rows the run gets to),
+    'skipped' (list of (row number, reason) for rows expected to fail),
+    'aborted' ((row number, reason) of the row that stops the run, None if
+    the run is expected to finish), 'unknown_size' (number of videos whose
+    size is not known), 'api_calls' (dict of number of calls by API method),
+    'download_bytes', 'upload_bytes' and 'seconds' (projected wall-clock
+    time)
+  """
+  api_calls = dict(video_uploader.INITIALIZE_API_CALLS)
+  skipped = []
+  aborted = None
+  processed = 0
+  # (size, downloaded) of each video to be uploaded
+  videos = []
+  for row_number, row in enumerate(rows, 1):
+    plan = plan_row(row)
+    if plan['aborts']:
+      aborted = (row_number, plan['error'])
+      break
+    processed += 1
+    if plan['error']:
+      skipped.append((row_number, plan['error']))
+      continue
+    for method, count in video_uploader.NEW_VIDEO_API_CALLS.items():
+      api_calls[method] = api_calls.get(method, 0) + count
+    videos.append((plan['size'], plan['downloaded']))
+
+  if not aborted:
+    # Ads are only activated once every row has been processed
+    for method, count in video_uploader.ACTIVATE_AD_API_CALLS.items():
+      api_calls[method] = api_calls.get(method, 0) + count * len(videos)
+
+  # Videos whose size is unknown are assumed to have the average size
+  known_sizes = [size for size, _ in videos if size is not None]
+  average_size = (
+      sum(known_sizes) / float(len(known_sizes)) if known_sizes else 0)
+  sizes = [average_size if size is None else size for size, _ in videos]
+  upload_bytes = sum(sizes)
+  download_bytes = sum(
+      size for size, (_, downloaded) in zip(sizes, videos) if downloaded)
+  bytes_per_second = bandwidth * 1000000 / 8
+  seconds = (sum(api_calls.values()) * call_latency +
+             (upload_bytes + download_bytes) / bytes_per_second)
+  return {'rows': len(rows), 'processed': processed, 'skipped': skipped,
+          'aborted': aborted,
+          'unknown_size': len(videos) - len(known_sizes),
+          'api_calls': api_calls, 'download_bytes': int(download_bytes),
+          'upload_bytes': int(upload_bytes), 'seconds': seconds}
+
+
+def print_plan(plan, call_latency, bandwidth, normalize=False):
+  """Print the result of plan_run() in human-readable form.
+
+  Args:
+    plan: Dict returned by plan_run().
+    call_latency: Latency of a DCM API call used for the plan, in seconds.
+    bandwidth: Network bandwidth used for the plan, in Mbit/s.
+    normalize: Whether videos will be normalised before being uploaded.
+  """
+  lines = ["Rows: {}, to be processed: {}, expected to fail: {}".format(
+      plan['rows'], plan['processed'] - len(plan['skipped']),
+      len(plan['skipped']))]
+  for row_number, reason in plan['skipped']:
+    lines.append("  Row {}: {}".format(row_number, reason))
+  if plan['aborted']:
+    lines.append("Row {} will abort the run: {}. Rows after it will not be "
+                 "processed and no ad will be activated".format(
+                     *plan['aborted']))
+  lines.append("DCM API calls: {} (assuming every ad is activated on the "
+               "first round; each further round repeats the calls for the "
+               "ads still pending)".format(sum(plan['api_calls'].values())))
+  for method in sorted(plan['api_calls']):
+    lines.append("  {}: {}".format(method, plan['api_calls'][method]))
+  lines.append("Bytes to download: {:.1f} MB".format(
+      plan['download_bytes'] / 1000000.0))
+  lines.append("Bytes to upload: {:.1f} MB".format(
+      plan['upload_bytes'] / 1000000.0))
+  if plan['unknown_size']:
+    lines.append("  Size unknown for {} videos, assumed to be the average "
+                 "size".format(plan['unknown_size']))
+  if normalize:
+    lines.append("  Sizes are those of the original videos. With "
+                 "--normalize_videos the files actually uploaded may be "
+                 "smaller")
+  lines.append("Projected wall-clock time: {:.0f} s ({:.3f} s per API call, "
+               "{} Mbit/s), not including time spent waiting for DCM to "
+               "transcode videos".format(
+                   plan['seconds'], call_latency, bandwidth))
+  print("\n".join(lines))
+
+
+def process_row(row, uploader, recorder, preprocessor=None):
   """Process row (e.g.: dict as returned by CSV) and add video to DCM.
 
   This method processes a row, which is a dict as returned by a CSVReader. It
   will extract the information about a video contained in that row (name,
   target ZIP code, video file/video URL, landing page), and add the video to
-  DCM as new creative.
+  DCM as new creative. If a MediaPreprocessor is provided, the video is probed
+  and, if configured, normalised before being uploaded.
 
   After executing this method, if video could be added successfully, a new
   ad will be present on DCM, with the video as associated creative, and with
@@ -133,8 +398,11 @@ def process_row(row, uploader, failure_writer):
     row: dict containing information about one video. Can be the row as output
       from a CSVReader.
     uploader: Instance of VideoUploader to be used to do the trafficking on DCM.
-    failure_writer: Information about videos that could not be added will be
-      added to this CSVWriter.
+    recorder: Instance of ResultsRecorder. The outcome of the row, including
+      the time spent on each stage, will be recorded there as soon as it is
+      known.
+    preprocessor: Optional instance of MediaPreprocessor to be used to probe
+      and normalise the video before uploading it.
 
   Returns:
     ID of the newly created ad on DCM if the operation suceeded. None otherwise.
@@ -151,6 +419,8 @@ def process_row(row, uploader, failure_writer):
   logger.info("Processing creative '%s'", creative_name)
 
 
+  # Time spent on each stage of the row, in seconds
+  durations = {}
   video_downloaded = False
   try:
     # Download video file if it wasn't provided in the metadata
@@ -159,21 +429,37 @@ def process_row(row, uploader, failure_writer):
       video_url = row[COLUMN_FILE_URL]
       video_file = creative_name
       logger.info("Downloading video on URL '%s'", video_url)
+      start = time.time()
       download_file(video_url, video_file)
+      durations['download'] = time.time() - start
       logger.info("Video file downloaded")
+    upload_file = video_file
+    if preprocessor:
+      # Probe and normalise video before uploading it. Normalised videos are
+      # kept in the cache, so only the original file is removed below
+      start = time.time()
+      upload_file = preprocessor.preprocess(video_file)[1]
+      durations['preprocess'] = time.time() - start
     logger.info("Adding element: '%s', '%s', '%s', '%s'",
-        creative_name, video_file, target_zip_code, landing_url)
+        creative_name, upload_file, target_zip_code, landing_url)
 
     # Invoke VideoUploader to actually traffic new video and ad into DCM
-    created_ad_id = uploader.new_video(creative_name, video_file,
+    upload_size = os.path.getsize(upload_file)
+    info = uploader.traffic_video(creative_name, upload_file,
                         target_zip_code, landing_url)
+    durations.update(info['timings'])
+    created_ad_id = info['ad_id']
   except Exception as e:
     logger.error("Exception while processing row: '%s'. Exception: %s", row, e)
-    # If video could not be added, log it to failure_writer. We do not propagate
+    # If video could not be added, record it as failed. We do not propagate
     # the exception to let the script continue with the next video
-    failure_writer.writerow(
-        [creative_name, target_zip_code, video_file, landing_url,
-         "{}".format(e)])
+    recorder.row_failed(creative_name, target_zip_code, video_file,
+                        landing_url, "{}".format(e), durations)
+  else:
+    # The ad already exists on DCM at this point, so an error while recording
+    # it must not be reported as a failed row
+    recorder.ad_created(creative_name, video_file, info, upload_size,
+                        durations)
   finally:
     if video_downloaded:
       # Remove video vile if it was downloaded by this method
@@ -197,6 +483,25 @@ def main(argv):
   # Retrieve command line arguments.
   flags = video_uploader.process_args(argv, argparser)
 
+  profiler = None
+  if flags.profile:
+    profiler = run_profiler.SamplingProfiler(flags.profile_interval / 1000.0)
+    profiler.start()
+  try:
+    run(flags)
+  finally:
+    if profiler:
+      profiler.stop()
+      profiler.write(flags.profile, flags.profile_top)
+
+
+def run(flags):
+  """Upload all videos in the creatives list, or plan the run.
+
+  Args:
+    flags: Command-line arguments, as returned by
+      video_uploader.process_args()
+  """
   profile_id = flags.profile_id
   campaign_id = flags.campaign_id
   placement_id = flags.placement_id
@@ -204,33 +509,86 @@ def main(argv):
   creatives_list = flags.creatives_list
   success_file = flags.success_file
   failure_file = flags.failure_file
+  created_file = flags.created_file or (
+      os.path.splitext(success_file)[0] + '_created.csv')
 
-  # Create and initialize VideoUploader
+  # Create VideoUploader
   uploader = video_uploader.VideoUploader(
       profile_id, advertiser_id, campaign_id, placement_id)
+
+  if flags.plan:
+    # Only estimate the cost of the run, without adding anything to DCM
+    call_latency = flags.plan_call_latency
+    if flags.plan_measure_latency:
+      uploader.initialize(flags)
+      call_latency = uploader.measure_call_latency()
+    with open(creatives_list) as csvfile:
+      plan = plan_run(
+          list(csv.DictReader(csvfile)), call_latency, flags.plan_bandwidth)
+    print_plan(plan, call_latency, flags.plan_bandwidth,
+               flags.normalize_videos)
+    return
+
+  # Initialize VideoUploader
   uploader.initialize(flags)
 
+  # Create MediaPreprocessor if videos must be probed or normalised locally
+  preprocessor = None
+  if flags.probe_videos or flags.normalize_videos:
+    preprocessor = media_preprocessor.MediaPreprocessor(
+        normalize=flags.normalize_videos,
+        cache_dir=flags.normalize_cache_dir,
+        video_codec=flags.normalize_codec,
+        max_bit_rate=flags.normalize_max_bitrate,
+        max_height=flags.normalize_max_height,
+        workers=flags.normalize_workers)
+    # Fail before the first row rather than on every row
+    preprocessor.check_tools()
+
   new_ads = []
+  events_file = open(flags.events_file, 'w') if flags.events_file else None
 
   # Open and process CSV file with all videos to be uploaded
   with open(creatives_list) as csvfile, \
     open_csv(success_file, 'w') as success_csv, \
-    open_csv(failure_file, 'w') as failure_csv:
+    open_csv(failure_file, 'w') as failure_csv, \
+    open_csv(created_file, 'w') as created_csv:
 
-    # Create CSV readers and writers
+    # Create CSV reader and the recorder that writes the results of each row
+    # as soon as they are known
     reader = csv.DictReader(csvfile)
-    success_writer = csv.writer(success_csv)
-    failure_writer = csv.writer(failure_csv)
-
-    for row in reader:
-      new_ad_id = process_row(row, uploader, failure_writer)
-      # If ad could be created, add its ID to the list of created ads
-      if new_ad_id:
-        new_ads.append(new_ad_id)
-
-    # Activate all newly created ads
-    logger.info("Activating ads...")
-    uploader.activate_all_ads(new_ads, success_writer)
+    rows = list(reader)
+    progress = run_reporter.ProgressReporter(
+        len(rows), interval=flags.progress_interval)
+    recorder = run_reporter.ResultsRecorder(
+        success_csv, failure_csv, created_csv, events_file, progress)
+
+    progress.start()
+    try:
+      try:
+        if preprocessor:
+          # Start processing local videos in the background, so that they are
+          # ready by the time their rows are reached
+          preprocessor.prefetch([row[COLUMN_FILENAME] for row in rows
+                                 if row.get(COLUMN_FILENAME)])
+
+        for row in rows:
+          new_ad_id = process_row(row, uploader, recorder, preprocessor)
+          # If ad could be created, add its ID to the list of created ads
+          if new_ad_id:
+            new_ads.append(new_ad_id)
+      finally:
+        if preprocessor:
+          preprocessor.close()
+
+      # Activate all newly created ads
+      logger.info("Activating ads...")
+      uploader.activate_all_ads(new_ads, recorder.success_writer)
+    finally:
+      progress.stop()
+      logger.info(progress.summary())
+      if events_file:
+        events_file.close()
 
 
 
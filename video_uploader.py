@@ -39,13 +39,32 @@ to execute your script with the option '--noauth_local_webserver'
 import logging
 import re
 import dfareporting_utils
+import httplib2
+import threading
 import time
+from googleapiclient import discovery
 from googleapiclient.http import MediaFileUpload
 from googleapiclient.errors import HttpError
+from oauth2client import file as oauth_file
 from retrying import retry
 
 AD_NAME_PREFIX = "AD_"
 
+# DCM API calls made by VideoUploader, by API method. These are used to plan
+# runs in advance, so keep them in sync with the methods below.
+# Calls made by initialize()
+INITIALIZE_API_CALLS = {'campaigns.list': 1}
+# Calls made by new_video() for each video
+NEW_VIDEO_API_CALLS = {
+    'creativeAssets.insert': 1,
+    'creatives.insert': 1,
+    'campaignCreativeAssociations.insert': 1,
+    'ads.insert': 1
+}
+# Calls made by activate_all_ads() for each ad on every activation round in
+# which the ad is still inactive
+ACTIVATE_AD_API_CALLS = {'ads.list': 1, 'creatives.list': 1, 'ads.update': 1}
+
 # Configure logging
 logger = logging.getLogger(__name__)
 if __name__ == '__main__':
@@ -132,6 +151,11 @@ class VideoUploader(object):
     4. Call activate_all_ads() and pass the list of all ad IDs created by
       calling new_video() on step 3
 
+  Instances of this class can be shared between threads once initialized:
+  every thread gets its own connection to the DCM API. For an asyncio
+  interface that uploads and activates videos concurrently, see
+  stream_videos().
+
   After adding a video, DCM takes some time to process and transcode the video
   file. You can't activate the ad until the video has been processed. By
   uploading all the videos first (step 3) and activating them afterwards
@@ -161,6 +185,9 @@ class VideoUploader(object):
     self._campaign_id = campaign_id
     self._placement_id = placement_id
     self._advertiser_id = advertiser_id
+    # Results of the ads created by stream_videos() after it was stopped,
+    # which were never yielded. See AsyncVideoUploader.stream_videos()
+    self.orphaned_results = []
 
   def initialize(self, flags):
     """Initialize this instance of VideoUploader.
@@ -172,10 +199,52 @@ class VideoUploader(object):
       flags: result fo processing command line arguments. You must pass the
           output of process_args() method on this same module
     """
-    self._service = dfareporting_utils.setup(flags)
+    # Credentials are loaded once and shared by the services of all threads,
+    # so the authorization flow runs at most once and token refreshes go
+    # through the same object
+    storage = oauth_file.Storage(dfareporting_utils.CREDENTIAL_STORE_FILE)
+    credentials = storage.get()
+    if credentials is None or credentials.invalid:
+      # Run the authorization flow, which stores the new credentials
+      dfareporting_utils.setup(flags)
+      credentials = storage.get()
+    self._credentials = credentials
+    self._thread_data = threading.local()
     self._campaign = self._get_element_by_id('campaigns', self._campaign_id)
 
-  
+  @property
+  def _service(self):
+    """DCM API service for the current thread.
+
+    HTTP connections used by the Google API client cannot be shared between
+    threads, so a new service is built the first time each thread needs it,
+    authorized with the credentials loaded by initialize().
+    """
+    service = getattr(self._thread_data, 'service', None)
+    if service is None:
+      http = self._credentials.authorize(httplib2.Http())
+      service = discovery.build(dfareporting_utils.API_NAME,
+                                dfareporting_utils.API_VERSION, http=http)
+      self._thread_data.service = service
+    return service
+
+  def measure_call_latency(self, samples=3):
+    """Measure the latency of DCM API calls.
+
+    This method retrieves the campaign several times and measures how long
+    each request takes. It does not modify anything on DCM.
+
+    Args:
+      samples: Number of requests to send.
+
+    Returns:
+      Average duration of a request, in seconds.
+    """
+    start = time.time()
+    for _ in range(samples):
+      self._get_element_by_id('campaigns', self._campaign_id)
+    return (time.time() - start) / samples
+
   def _upload_asset(self, asset_name, video_file):
     """Upload video asset.
 
@@ -215,7 +284,8 @@ class VideoUploader(object):
     return response['assetIdentifier']
 
 
-  def _add_video_creative(self, creative_desired_name, video_file, landing_url):
+  def _add_video_creative(self, creative_desired_name, video_file, landing_url,
+                          timings=None):
     """Create new video creative on DCM.
 
     This method creates a new video creative on DCM.
@@ -226,6 +296,9 @@ class VideoUploader(object):
         distinguish from already existing creatives.
       video_file: Video file name.
       landing_url: Landing URL for the newly added creative
+      timings: Optional dict. If provided, the time spent (seconds) uploading
+        the video and creating the creative will be stored under 'upload' and
+        'creative'
 
     Returns:
       Dict object with 'creative_id' and 'creative_name' for the newly added
@@ -236,7 +309,9 @@ class VideoUploader(object):
         a number of retries
     """
     # First, upload video to create new video asset
+    start = time.time()
     asset_id = self._upload_asset(creative_desired_name, video_file)
+    upload_end = time.time()
 
     creative_name = asset_id['name']
     # Construct the creative structure with the new video asset linked
@@ -273,6 +348,9 @@ class VideoUploader(object):
         campaignId=self._campaign_id, body=association)
     response = _execute_with_retries(request)
 
+    if timings is not None:
+      timings['upload'] = upload_end - start
+      timings['creative'] = time.time() - upload_end
     return {'creative_id': int(creative_id), 'creative_name': creative_name}
 
 
@@ -397,6 +475,50 @@ class VideoUploader(object):
     return {'ad_name': ad_name, 'ad_id': ad_id}
 
 
+  def traffic_video(self, creative_name, video_file, target_zip_code,
+                    landing_url):
+    """Add new video to DCM and report details about the new elements.
+
+    This method does exactly the same as new_video(), but returns information
+    about all the elements created on DCM and the time spent on each step.
+
+    Args:
+      creative_name: Name for the new creative on DCM. You must use a string
+        returned by the clean_up_creative_name() method on this module to
+        ensure it is a valid name for a creative on DCM.
+      video_file: Video filename.
+      target_zip_code: ZIP code to which this video must be targeted. The video
+        will only be shown to users who see the ad on that location.
+      landing_url: Landing URL for the ad when showing this specific video.
+
+    Returns:
+      Dict object with 'ad_id', 'ad_name', 'creative_id', 'creative_name' and
+      'timings' (dict with the seconds spent on 'upload', 'creative' and 'ad')
+
+    Raises:
+      HttpError: An error occured while sending requests to the server after
+        a number of retries
+    """
+    timings = {}
+    creative_info = self._add_video_creative(
+        creative_name, video_file, landing_url, timings)
+
+    creative_id = creative_info['creative_id']
+    creative_name = creative_info['creative_name']
+
+    logger.info(
+        "Added creative '%s' (ID: %d)",creative_name, creative_id)
+
+    start = time.time()
+    ad_info = self._assign_creative_to_placement(AD_NAME_PREFIX + creative_name,
+        creative_id, self._placement_id, target_zip_code, landing_url)
+    timings['ad'] = time.time() - start
+
+    return {'ad_id': ad_info['ad_id'], 'ad_name': ad_info['ad_name'],
+            'creative_id': creative_id, 'creative_name': creative_name,
+            'timings': timings}
+
+
   def new_video(self, creative_name, video_file, target_zip_code,
                    landing_url):
     """Add new video to DCM.
@@ -426,20 +548,11 @@ class VideoUploader(object):
       HttpError: An error occured while sending requests to the server after
         a number of retries
     """
-    creative_info = self._add_video_creative(
-        creative_name, video_file, landing_url)
+    return self.traffic_video(
+        creative_name, video_file, target_zip_code, landing_url)['ad_id']
 
-    creative_id = creative_info['creative_id']
-    creative_name = creative_info['creative_name']
-
-    logger.info(
-        "Added creative '%s' (ID: %d)",creative_name, creative_id)
 
-    return self._assign_creative_to_placement(AD_NAME_PREFIX + creative_name,
-        creative_id, self._placement_id, target_zip_code, landing_url)['ad_id']
-
-
-  def _activate_ad(self, ad_id):
+  def activate_ad(self, ad_id):
     """Activate one single ad.
 
     This method activates one single ad on DCM.
@@ -500,7 +613,7 @@ class VideoUploader(object):
     try:
       logger.info("Activating %d ads", len(ad_ids))
       for current_ad_id in ad_ids:
-        if self._activate_ad(current_ad_id):
+        if self.activate_ad(current_ad_id):
           ad_ids.remove(current_ad_id)
           success_writer.writerow([current_ad_id])
       if len(ad_ids) != 0:
@@ -514,4 +627,35 @@ class VideoUploader(object):
       logger.error("Unexpected exception while activating ads")
       raise
 
+  def stream_videos(self, rows, max_in_flight=4, activate=False,
+                    max_activations=None):
+    """Add videos to DCM concurrently from an asyncio event loop.
+
+    This method returns an asynchronous iterator that adds the videos described
+    by rows to DCM, with at most max_in_flight videos being uploaded at the
+    same time, and yields one result for each row as soon as it is finished.
+    It requires Python 3.6 or later. See AsyncVideoUploader in
+    async_video_uploader.py for details.
+
+    Args:
+      rows: Iterable or asynchronous iterable of dicts with the arguments of
+        new_video(): 'creative_name', 'video_file', 'target_zip_code' and
+        'landing_url'.
+      max_in_flight: Maximum number of videos being uploaded at the same time.
+      activate: Whether each ad must be activated as soon as it is created,
+        retrying with exponential back-off while DCM transcodes the video.
+      max_activations: Maximum number of ads waiting for activation at the
+        same time. Defaults to 4 times max_in_flight.
+
+    Returns:
+      Asynchronous iterator of dicts, one per row, as described in
+      AsyncVideoUploader.stream_videos(). Ads still being created when the
+      iterator is stopped are added to orphaned_results instead.
+    """
+    # Imported here so that this module can still be used from Python versions
+    # without asyncio
+    import async_video_uploader
+    return async_video_uploader.AsyncVideoUploader(
+        self, max_in_flight, max_activations).stream_videos(rows, activate)
+
 